@@ -1,10 +1,19 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import time
+
+import six
+from django.utils import timezone
 from django.utils.translation import get_language
-from django.http import HttpResponse, HttpResponseForbidden, HttpResponseRedirect
+from django.core.exceptions import ImproperlyConfigured
+from django.http import Http404, HttpResponse, HttpResponseForbidden, HttpResponseRedirect
+from django.urls import reverse
 
-from payments.core import BasicProvider
+from payments import get_payment_model
+from payments.core import BasicProvider, get_base_url
 from .forms import ProcessPaymentForm
+from .audit import AuditLog
+from .profiling import profiled
 from . import helpers
 
 
@@ -17,6 +26,15 @@ def normalize_url(url):
 
 class GpwebpayProvider(BasicProvider):
     _method = 'post'
+    # columns loaded by process_notification(): enough to change status
+    # and save it back without touching the rest of the payment row.
+    # With use_redirect the payment's get_success_url() and
+    # get_failure_url() also run on this instance, so any column they read
+    # has to be listed in the notification_payment_fields option, otherwise
+    # each one costs an extra SELECT.
+    notification_payment_fields = (
+        'id', 'variant', 'status', 'message', 'token', 'modified'
+    )
 
     def __init__(self, *args, **kwargs):
         self.merchant_id = kwargs.pop('merchant_id', None)
@@ -24,6 +42,31 @@ class GpwebpayProvider(BasicProvider):
         self.public_key = kwargs.pop('public_key', None)
         self.passphrase_for_key = kwargs.pop('passphrase_for_key', None)
         self.use_redirect = kwargs.pop('use_redirect', True)
+        self.use_notification_view = kwargs.pop('use_notification_view', False)
+        self.notification_payment_fields = \
+            tuple(self.notification_payment_fields) + \
+            tuple(kwargs.pop('notification_payment_fields', ()))
+        self.order_number_allocator = helpers.load_component(
+            kwargs.pop(
+                'order_number_allocator',
+                'payments_gpwebpay.ordernumbers.PaymentIdAllocator'
+            ),
+            kwargs.pop('order_number_allocator_options', None)
+        )
+        audit_sink = kwargs.pop('audit_sink', None)
+        audit_sink_options = kwargs.pop('audit_sink_options', None)
+        audit_options = kwargs.pop('audit_options', None) or {}
+        self.audit_log = None
+        if audit_sink:
+            self.audit_log = AuditLog(
+                helpers.load_component(audit_sink, audit_sink_options),
+                **audit_options
+            )
+        profiler = kwargs.pop('profiler', None)
+        profiler_options = kwargs.pop('profiler_options', None)
+        self.profiler = None
+        if profiler:
+            self.profiler = helpers.load_component(profiler, profiler_options)
 
         self.language = kwargs.pop('language', None)
         self.operation_description = kwargs.pop('operation_description', None)
@@ -93,22 +136,52 @@ class GpwebpayProvider(BasicProvider):
 
     def get_return_url(self, payment, extra_data=None):
         from django.conf import settings
-        url = super(GpwebpayProvider, self).get_return_url(
-            payment,
-            extra_data=extra_data
-        )
+        if self.use_notification_view:
+            url = get_base_url() + reverse(
+                'gpwebpay_process_payment',
+                kwargs={'variant': payment.variant}
+            )
+            if extra_data:
+                url = helpers.add_params_to_url(url, extra_data)
+        else:
+            url = super(GpwebpayProvider, self).get_return_url(
+                payment,
+                extra_data=extra_data
+            )
         if hasattr(settings, 'TEST_SITE_URL'):
             return settings.TEST_SITE_URL
         if hasattr(settings, 'TEST_HOSTNAME'):
             return url.replace('localhost:8000', settings.TEST_HOSTNAME)
         return url
 
+    def audit(self, kind, payment_id, fields, outcome, started, errors=None):
+        if self.audit_log is None:
+            return
+        self.audit_log.record({
+            'created': timezone.now(),
+            'kind': kind,
+            'payment_id': payment_id and "%s" % payment_id,
+            'order_number': fields.get('ORDERNUMBER'),
+            'outcome': outcome,
+            'duration': time.time() - started,
+            'fields': dict(
+                (k, helpers.to_str(v)) for k, v in fields.items()
+            ),
+            'errors': dict(
+                (k, [six.text_type(e) for e in v] if isinstance(v, list)
+                    else [six.text_type(v)])
+                for k, v in (errors or {}).items()
+            ),
+        })
+
+    @profiled('get_hidden_fields')
     def get_hidden_fields(self, payment):
+        started = time.time()
         order_id = "%s" % payment.id
         data = {
             'MERCHANTNUMBER': self.merchant_id,
             'OPERATION': 'CREATE_ORDER',
-            'ORDERNUMBER': order_id,
+            'ORDERNUMBER': self.order_number_allocator.allocate(payment),
             'MERORDERNUM': order_id,
             'AMOUNT': self.get_price(payment.total),
             'CURRENCY': self.get_currency(payment.currency),
@@ -129,16 +202,70 @@ class GpwebpayProvider(BasicProvider):
             'URL', 'DESCRIPTION', 'MD'
         ])
         data['DIGEST'] = helpers.to_str(self.signature.sign(digest))
+        self.audit('request', payment.id, data, 'signed', started)
         return data
 
-    def process_data(self, payment, request):
-        form = ProcessPaymentForm(
+    def get_process_form(self, payment, request):
+        return ProcessPaymentForm(
             self.merchant_id,
             self.signature,
             payment,
-            data=request.GET or {}
+            data=request.GET or {},
+            payment_id_field=self.order_number_allocator.payment_id_field
+        )
+
+    def get_payment_id(self, cleaned_data):
+        return self.order_number_allocator.get_payment_id(cleaned_data)
+
+    def get_notification_payment(self, payment_id):
+        Payment = get_payment_model()
+        return Payment.objects.only(
+            *self.notification_payment_fields
+        ).get(id=payment_id)
+
+    @profiled('process_data')
+    def process_data(self, payment, request):
+        started = time.time()
+        form = self.get_process_form(payment, request)
+        return self.process_form(payment, form, started=started)
+
+    @profiled('process_notification')
+    def process_notification(self, request, variant):
+        """
+        Verifies the callback before the database is touched, then loads
+        only the columns needed for the status change.
+        """
+        started = time.time()
+        form = self.get_process_form(None, request)
+        if not form.is_verified():
+            self.audit(
+                'callback', None, form.data, 'rejected', started,
+                errors=form.errors
+            )
+            return HttpResponseForbidden('<PaymentNotification>Rejected</PaymentNotification>')
+        payment_id = self.get_payment_id(form.cleaned_data)
+        if not payment_id:
+            raise Http404('No such payment')
+        try:
+            payment = self.get_notification_payment(payment_id)
+        except (ValueError, get_payment_model().DoesNotExist):
+            raise Http404('No such payment')
+        if payment.variant != variant:
+            raise Http404('No such payment')
+        form.payment = payment
+        return self.process_form(payment, form, started=started)
+
+    def process_form(self, payment, form, started=None):
+        valid = form.is_valid()
+        self.audit(
+            'callback',
+            payment.id,
+            form.data,
+            'accepted' if valid else 'rejected',
+            started or time.time(),
+            errors=form.errors
         )
-        if not form.is_valid():
+        if not valid:
             cleaned_data = getattr(form, 'cleaned_data', None) or {}
             if self.use_redirect:
                 url = payment.get_failure_url()
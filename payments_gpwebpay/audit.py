@@ -0,0 +1,278 @@
+from __future__ import unicode_literals
+import atexit
+import gzip
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+import six
+from six.moves import queue
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+OVERFLOW_DROP = 'drop'
+OVERFLOW_BLOCK = 'block'
+
+# seconds between two warnings about dropped events
+DROP_WARNING_INTERVAL = 60
+
+_file_counter = itertools.count()
+
+# queued by close() to wake the writer thread up
+_WAKE_UP = object()
+
+
+class ModelAuditSink(object):
+    '''
+    Writes audit events to a model (AuditEvent by default) with bulk_create.
+    '''
+
+    def __init__(self, model='payments_gpwebpay.AuditEvent', using=None):
+        self.model = model
+        self.using = using
+
+    def get_model(self):
+        from django.apps import apps
+        if isinstance(self.model, six.string_types):
+            return apps.get_model(self.model)
+        return self.model
+
+    def write(self, events):
+        Model = self.get_model()
+        Model.objects.using(self.using).bulk_create([
+            Model(
+                created=event['created'],
+                kind=event['kind'],
+                payment_id=event['payment_id'] or '',
+                order_number=event['order_number'] or '',
+                outcome=event['outcome'],
+                duration=event['duration'],
+                fields=json.dumps(event['fields'], cls=DjangoJSONEncoder),
+                errors=json.dumps(event['errors'], cls=DjangoJSONEncoder),
+            )
+            for event in events
+        ])
+
+
+class JsonlAuditSink(object):
+    '''
+    Appends audit events as JSON lines to gzip files in `directory`.
+
+    Every batch is written as a separate gzip member, so a file stays
+    readable if the process dies. A new file is started once the current
+    one reaches max_bytes or is older than max_age seconds.
+    '''
+
+    def __init__(self, directory, prefix='gpwebpay-audit',
+                 max_bytes=64 * 1024 * 1024, max_age=24 * 60 * 60):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.path = None
+        self.opened = None
+
+    def get_path(self):
+        now = time.time()
+        if self.path is None or self.opened + self.max_age <= now \
+                or os.path.getsize(self.path) >= self.max_bytes:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self.path = os.path.join(self.directory, '%s-%s-%s-%s.jsonl.gz' % (
+                self.prefix,
+                time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)),
+                os.getpid(),
+                next(_file_counter)
+            ))
+            self.opened = now
+        return self.path
+
+    def write(self, events):
+        lines = ''.join([
+            json.dumps(event, cls=DjangoJSONEncoder, sort_keys=True) + '\n'
+            for event in events
+        ])
+        try:
+            with gzip.open(self.get_path(), 'ab') as f:
+                f.write(lines.encode('utf-8'))
+        except (IOError, OSError):
+            # the file or directory may be gone: start a new file next time
+            self.path = None
+            raise
+
+
+class AuditLog(object):
+    '''
+    In-process buffer of audit events flushed to `sink` in batches by a
+    background thread. A batch is written once it has batch_size events
+    or flush_interval seconds after its first event.
+
+    At most buffer_size events are kept in memory. When the buffer is full
+    record() either drops the event (overflow='drop', the default) or
+    waits up to block_timeout seconds for free space (overflow='block').
+    A batch the sink fails to write is retried `retries` times,
+    retry_delay seconds apart, and then dropped. Dropped events are
+    counted in self.dropped and logged as a warning. overflow='block' with
+    block_timeout=None keeps every event the sink can write.
+
+    On interpreter exit the writer thread gets close_timeout seconds to
+    finish its batch, then the rest is flushed.
+
+    With threaded=False no thread is started: record() writes a batch
+    from the calling thread once batch_size events are buffered, and
+    flush() writes the rest.
+    '''
+
+    def __init__(self, sink, buffer_size=10000, batch_size=500,
+                 flush_interval=5.0, overflow=OVERFLOW_DROP,
+                 block_timeout=None, close_timeout=5.0, retries=3,
+                 retry_delay=1.0, threaded=True):
+        if overflow not in [OVERFLOW_DROP, OVERFLOW_BLOCK]:
+            raise ValueError("Unknown audit overflow policy '%s'" % overflow)
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.close_timeout = close_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.threaded = threaded
+        self.dropped = 0
+        self._warned = None
+        self._queue = queue.Queue(maxsize=buffer_size)
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.close)
+
+    def _thread_running(self):
+        # threads are not inherited by forked workers
+        return self._pid == os.getpid() and self._thread.is_alive()
+
+    def _ensure_thread(self):
+        if self._thread_running():
+            return
+        with self._start_lock:
+            if self._thread_running():
+                return
+            self._thread = threading.Thread(
+                target=self._run,
+                name='gpwebpay-audit'
+            )
+            self._thread.daemon = True
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def record(self, event):
+        if self._stopped.is_set():
+            return False
+        if self.threaded:
+            self._ensure_thread()
+        try:
+            if self.overflow == OVERFLOW_BLOCK:
+                self._queue.put(event, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(event)
+        except queue.Full:
+            self._drop(1)
+            return False
+        if not self.threaded and self._queue.qsize() >= self.batch_size:
+            self._write(self._take_batch(timeout=0))
+        return True
+
+    def _drop(self, count):
+        self.dropped += count
+        now = time.time()
+        if self._warned is None \
+                or now - self._warned >= DROP_WARNING_INTERVAL:
+            self._warned = now
+            logger.warning(
+                "%s GpWebPay audit events dropped so far", self.dropped
+            )
+
+    def _take_batch(self, timeout=None, linger=0):
+        '''
+        Waits up to `timeout` seconds for an event, then collects more
+        until batch_size is reached or `linger` seconds have passed.
+        '''
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=timeout))
+        except queue.Empty:
+            return batch
+        deadline = time.time() + linger
+        # close() queues _WAKE_UP to have the batch written at once
+        while len(batch) < self.batch_size and batch[-1] is not _WAKE_UP:
+            try:
+                batch.append(self._queue.get(
+                    timeout=max(deadline - time.time(), 0)
+                ))
+            except queue.Empty:
+                break
+        return [event for event in batch if event is not _WAKE_UP]
+
+    def _write(self, batch, reconnect=False):
+        if not batch:
+            return
+        with self._write_lock:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    self._stopped.wait(self.retry_delay)
+                if reconnect:
+                    # the thread keeps its own connection, which may have
+                    # been broken by a database restart or the last attempt
+                    close_old_connections()
+                try:
+                    self.sink.write(batch)
+                    break
+                except Exception:
+                    # the audit log must never break payment processing
+                    logger.exception(
+                        "Could not write %s GpWebPay audit events "
+                        "(attempt %s of %s)",
+                        len(batch), attempt + 1, self.retries + 1
+                    )
+            else:
+                self._drop(len(batch))
+            if reconnect:
+                close_old_connections()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._write(
+                self._take_batch(
+                    timeout=self.flush_interval,
+                    linger=self.flush_interval
+                ),
+                reconnect=True
+            )
+
+    def flush(self):
+        '''
+        Writes all buffered events from the calling thread.
+        '''
+        batch = self._take_batch(timeout=0)
+        while batch:
+            self._write(batch)
+            batch = self._take_batch(timeout=0)
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread_running() \
+                and self._thread is not threading.current_thread():
+            try:
+                self._queue.put_nowait(_WAKE_UP)
+            except queue.Full:
+                # the writer is busy and checks the stop flag after its batch
+                pass
+            self._thread.join(self.close_timeout)
+        self.flush()
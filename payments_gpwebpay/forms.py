@@ -20,6 +20,13 @@ GATEWAY_PRCODE_PAYMENT_ERRORS = [
 ]
 
 
+def get_payment_status(prcode):
+    if prcode == '0':
+        # all ok
+        return PaymentStatus.CONFIRMED
+    return PaymentStatus.REJECTED
+
+
 class ProcessPaymentForm(forms.Form):
     OPERATION = forms.CharField(required=True)
     ORDERNUMBER = forms.CharField(required=True)
@@ -34,26 +41,30 @@ class ProcessPaymentForm(forms.Form):
     DIGEST = forms.CharField(required=True)
     DIGEST1 = forms.CharField(required=True)
 
-    def __init__(self, merchant_id, signature, payment, **kwargs):
+    def __init__(self, merchant_id, signature, payment,
+                 payment_id_field='ORDERNUMBER', **kwargs):
         self.merchant_id = merchant_id
         self.signature = signature
         self.payment = payment
+        self.payment_id_field = payment_id_field
         super(ProcessPaymentForm, self).__init__(**kwargs)
 
     def clean(self):
         cleaned_data = super(ProcessPaymentForm, self).clean()
         if not self.errors:
-            order_id = "%s" % self.payment.id
-            if cleaned_data['ORDERNUMBER'] != order_id:
-                self._errors['ORDERNUMBER'] = self.error_class(
-                    ['Bad payment id (ORDERNUMBER field)'])
+            # without a payment (notification view) the payment is looked up
+            # by payment_id_field only after the digests below are verified
+            if self.payment is not None:
+                order_id = "%s" % self.payment.id
+                field = self.payment_id_field
+                if cleaned_data.get(field) != order_id:
+                    self._errors[field] = self.error_class(
+                        ['Bad payment id (%s field)' % field])
 
-            digest = helpers.generate_digest(cleaned_data, [
-                'OPERATION', 'ORDERNUMBER', 'MERORDERNUM', 'MD',
-                'PRCODE', 'SRCODE', 'RESULTTEXT', 'DETAILS',
-                'USERPARAM1', 'ADDINFO'
-            ])
-            digest1 = "%s|%s" % (digest, self.merchant_id)
+            digest, digest1 = helpers.generate_callback_digests(
+                cleaned_data,
+                self.merchant_id
+            )
 
             verified = self.signature.verify(
                 digest,
@@ -74,9 +85,15 @@ class ProcessPaymentForm(forms.Form):
                 )
         return cleaned_data
 
+    def is_verified(self):
+        """
+        True when all required fields are present and both digests are
+        valid, even if the gateway reported a payment error in PRCODE.
+        """
+        self.is_valid()
+        return not [k for k in self.errors if k != 'PRCODE']
+
     def save(self, *args, **kwargs):
-        if self.cleaned_data['PRCODE'] == '0':
-            # all ok
-            self.payment.change_status(PaymentStatus.CONFIRMED)
-        else:
-            self.payment.change_status(PaymentStatus.REJECTED)
+        self.payment.change_status(
+            get_payment_status(self.cleaned_data['PRCODE'])
+        )
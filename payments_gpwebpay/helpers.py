@@ -20,6 +20,15 @@ def to_str(data):
     return data
 
 
+# field order of the DIGEST sent back by GpWebPay; DIGEST1 is the same
+# digest followed by "|MERCHANTNUMBER"
+CALLBACK_DIGEST_FIELDS = [
+    'OPERATION', 'ORDERNUMBER', 'MERORDERNUM', 'MD',
+    'PRCODE', 'SRCODE', 'RESULTTEXT', 'DETAILS',
+    'USERPARAM1', 'ADDINFO'
+]
+
+
 def generate_digest(query_params, fields):
     digest = []
     for k in fields:
@@ -30,6 +39,11 @@ def generate_digest(query_params, fields):
         for d in digest
     ])
 
+
+def generate_callback_digests(query_params, merchant_id):
+    digest = generate_digest(query_params, CALLBACK_DIGEST_FIELDS)
+    return digest, "%s|%s" % (digest, merchant_id)
+
 '''
 def generate_addinfo(params):
     lines = []
@@ -40,6 +54,17 @@ def generate_addinfo(params):
 '''
 
 
+def load_component(component, options=None):
+    """
+    Returns `component` as is, or an instance of the class at the dotted
+    path `component` created with `options` as keyword arguments.
+    """
+    if not isinstance(component, six.string_types):
+        return component
+    from django.utils.module_loading import import_string
+    return import_string(component)(**(options or {}))
+
+
 def add_params_to_url(url, params):
     try:
         import urlparse
@@ -55,23 +80,14 @@ def add_params_to_url(url, params):
     return urlparse.urlunparse(url_parts)
 
 
-class RsaSignature(object):
+class RsaVerifier(object):
 
-    def __init__(self, private_key, public_key, passphrase):
-        self.private_key = crypto.load_privatekey(
-            crypto.FILETYPE_PEM,
-            to_bytes(private_key),
-            to_bytes(passphrase)
-        )
+    def __init__(self, public_key):
         self.public_key = crypto.load_certificate(
             crypto.FILETYPE_PEM,
             to_bytes(public_key)
         )
 
-    def sign(self, text):
-        sign = OpenSSL.crypto.sign(self.private_key, text, "sha1")
-        return b64encode(sign)
-
     def verify(self, data, signature):
         try:
             signature = b64decode(signature)
@@ -87,3 +103,18 @@ class RsaSignature(object):
             return True
         except crypto.Error:
             return False
+
+
+class RsaSignature(RsaVerifier):
+
+    def __init__(self, private_key, public_key, passphrase):
+        super(RsaSignature, self).__init__(public_key)
+        self.private_key = crypto.load_privatekey(
+            crypto.FILETYPE_PEM,
+            to_bytes(private_key),
+            to_bytes(passphrase)
+        )
+
+    def sign(self, text):
+        sign = OpenSSL.crypto.sign(self.private_key, text, "sha1")
+        return b64encode(sign)
@@ -0,0 +1,71 @@
+from __future__ import unicode_literals
+import os
+import pstats
+
+from six import StringIO
+
+from django.core.management.base import BaseCommand, CommandError
+
+from payments_gpwebpay.profiling import PROFILE_SUFFIX
+
+
+class Command(BaseCommand):
+    help = (
+        'Merges .prof files written by SamplingProfiler and prints the '
+        'top hot spots.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument(
+            '--name', action='append', default=[],
+            help='Only merge dumps of this call (get_hidden_fields, '
+                 'process_data, process_notification), may be repeated'
+        )
+        parser.add_argument('--prefix', default='gpwebpay')
+        parser.add_argument(
+            '--sort', default='cumulative',
+            help='pstats sort key, e.g. cumulative, tottime, calls'
+        )
+        parser.add_argument('--limit', type=int, default=30)
+        parser.add_argument(
+            '--output',
+            help='Also save the merged stats to this file'
+        )
+
+    def get_paths(self, directory, prefix, names):
+        paths = []
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(PROFILE_SUFFIX) \
+                    or not filename.startswith(prefix + '-'):
+                continue
+            name = filename[len(prefix) + 1:].rsplit('-', 3)[0]
+            if names and name not in names:
+                continue
+            paths.append(os.path.join(directory, filename))
+        return paths
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(options['directory']):
+            raise CommandError(
+                "'%s' is not a directory" % options['directory']
+            )
+        paths = self.get_paths(
+            options['directory'],
+            options['prefix'],
+            options['name']
+        )
+        if not paths:
+            raise CommandError('No profile dumps found')
+
+        out = StringIO()
+        stats = pstats.Stats(paths[0], stream=out)
+        for path in paths[1:]:
+            stats.add(path)
+        if options['output']:
+            stats.dump_stats(options['output'])
+        stats.strip_dirs() \
+            .sort_stats(options['sort']) \
+            .print_stats(options['limit'])
+        self.stdout.write('Merged %s profile dumps' % len(paths))
+        self.stdout.write(out.getvalue())
@@ -0,0 +1,214 @@
+from __future__ import unicode_literals
+import gzip
+import io
+import json
+import multiprocessing
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from payments import PaymentStatus
+from payments_gpwebpay import helpers
+from payments_gpwebpay.forms import (
+    GATEWAY_PRCODE_PAYMENT_ERRORS, get_payment_status
+)
+
+# certificates loaded once per worker process by init_worker()
+_verifiers = None
+_merchant_id = None
+
+
+def init_worker(certificates, merchant_id):
+    global _verifiers, _merchant_id
+    _verifiers = [
+        (name, helpers.RsaVerifier(pem))
+        for name, pem in certificates
+    ]
+    _merchant_id = merchant_id
+
+
+def verify_line(item):
+    '''
+    Verifies one archived callback against every certificate. Returns
+    the names of the certificates which verify DIGEST and DIGEST1, or None
+    for audit events of other kinds.
+    '''
+    line_number, line = item
+    result = {'line': line_number}
+    try:
+        record = json.loads(line)
+        if record.get('kind', 'callback') != 'callback':
+            return None
+        fields = record.get('fields', record)
+        # null fields were absent from the callback and are not signed
+        fields = dict(
+            (k, helpers.to_str(v)) for k, v in fields.items()
+            if v is not None
+        )
+    except (ValueError, AttributeError) as e:
+        result['error'] = "Invalid record: %s" % e
+        return result
+    merchant_id = _merchant_id or fields.get('MERCHANTNUMBER', '')
+    digest, digest1 = helpers.generate_callback_digests(fields, merchant_id)
+    result['ORDERNUMBER'] = fields.get('ORDERNUMBER')
+    result['PRCODE'] = fields.get('PRCODE')
+    result['status'] = record.get('status')
+    result['DIGEST'] = [
+        name for name, verifier in _verifiers
+        if verifier.verify(digest, fields.get('DIGEST', ''))
+    ]
+    result['DIGEST1'] = [
+        name for name, verifier in _verifiers
+        if verifier.verify(digest1, fields.get('DIGEST1', ''))
+    ]
+    return result
+
+
+def read_lines(path):
+    if path.endswith('.gz'):
+        f = io.TextIOWrapper(gzip.open(path, 'rb'), encoding='utf-8')
+    else:
+        f = io.open(path, encoding='utf-8')
+    with f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                yield line_number, line
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-verifies DIGEST and DIGEST1 of archived GpWebPay callbacks. '
+        'The archive has one JSON object per line: either the callback '
+        'fields or {"fields": {...}, "status": "<stored payment status>"}. '
+        'Audit logs written by JsonlAuditSink (.gz) can be passed as they '
+        'are; events other than callbacks are skipped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('archive')
+        parser.add_argument(
+            '--variant', default='default',
+            help='Payment variant providing merchant_id and public_key'
+        )
+        parser.add_argument(
+            '--certificate', action='append', default=[],
+            help='PEM certificate file to try, may be repeated. '
+                 'Defaults to the public_key of the variant.'
+        )
+        parser.add_argument(
+            '--merchant-id',
+            help='Merchant number used in DIGEST1, defaults to the '
+                 'variant merchant_id or the MERCHANTNUMBER field'
+        )
+        parser.add_argument(
+            '--processes', type=int, default=None,
+            help='Number of worker processes, defaults to CPU count'
+        )
+        parser.add_argument('--chunksize', type=int, default=256)
+        parser.add_argument(
+            '--report',
+            help='File for the JSON lines report of mismatching callbacks'
+        )
+
+    def get_variant_config(self, variant):
+        variants = getattr(settings, 'PAYMENT_VARIANTS', {})
+        return variants.get(variant, (None, {}))[1]
+
+    def get_certificates(self, options, config):
+        certificates = []
+        for path in options['certificate']:
+            with io.open(path, encoding='utf-8') as f:
+                certificates.append((path, f.read()))
+        if not certificates:
+            if not config.get('public_key'):
+                raise CommandError(
+                    "No --certificate given and variant '%s' has no "
+                    "public_key" % options['variant']
+                )
+            certificates.append((options['variant'], config['public_key']))
+        return certificates
+
+    def check_status(self, result):
+        if not result['status']:
+            return True
+        if result['PRCODE'] in GATEWAY_PRCODE_PAYMENT_ERRORS:
+            # process_data() does not change the status for gateway errors
+            return result['status'] != PaymentStatus.CONFIRMED
+        return result['status'] == get_payment_status(result['PRCODE'])
+
+    def handle(self, *args, **options):
+        config = self.get_variant_config(options['variant'])
+        certificates = self.get_certificates(options, config)
+        merchant_id = options['merchant_id'] or config.get('merchant_id')
+        processes = options['processes'] or multiprocessing.cpu_count()
+
+        summary = OrderedDict([
+            ('total', 0),
+            ('verified', 0),
+            ('bad_digest', 0),
+            ('bad_digest1', 0),
+            ('status_mismatch', 0),
+            ('invalid', 0),
+            ('certificates', OrderedDict(
+                (name, 0) for name, pem in certificates
+            )),
+        ])
+        report = io.open(options['report'], 'w', encoding='utf-8') \
+            if options['report'] else None
+        pool = None
+        try:
+            lines = read_lines(options['archive'])
+            if processes > 1:
+                pool = multiprocessing.Pool(
+                    processes,
+                    initializer=init_worker,
+                    initargs=(certificates, merchant_id)
+                )
+                results = pool.imap_unordered(
+                    verify_line, lines, options['chunksize']
+                )
+            else:
+                init_worker(certificates, merchant_id)
+                results = (verify_line(item) for item in lines)
+
+            for result in results:
+                if result is None:
+                    continue
+                summary['total'] += 1
+                problems = self.collect(summary, result)
+                if problems and report:
+                    result['problems'] = problems
+                    report.write(helpers.to_str(
+                        json.dumps(result, sort_keys=True)
+                    ) + '\n')
+            if pool:
+                pool.close()
+                pool.join()
+        finally:
+            if pool:
+                pool.terminate()
+            if report:
+                report.close()
+
+        self.stdout.write(json.dumps(summary, indent=2))
+
+    def collect(self, summary, result):
+        if 'error' in result:
+            summary['invalid'] += 1
+            return [result['error']]
+        problems = []
+        if not result['DIGEST']:
+            summary['bad_digest'] += 1
+            problems.append('DIGEST')
+        if not result['DIGEST1']:
+            summary['bad_digest1'] += 1
+            problems.append('DIGEST1')
+        if not problems:
+            summary['verified'] += 1
+        for name in set(result['DIGEST']) & set(result['DIGEST1']):
+            summary['certificates'][name] += 1
+        if not self.check_status(result):
+            summary['status_mismatch'] += 1
+            problems.append('status')
+        return problems
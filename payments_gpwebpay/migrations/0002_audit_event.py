@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-19 05:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_gpwebpay', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(db_index=True)),
+                ('kind', models.CharField(max_length=16)),
+                ('payment_id', models.CharField(blank=True, db_index=True, max_length=64)),
+                ('order_number', models.CharField(blank=True, max_length=32)),
+                ('outcome', models.CharField(max_length=16)),
+                ('duration', models.FloatField()),
+                ('fields', models.TextField()),
+                ('errors', models.TextField(blank=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,120 @@
+from __future__ import unicode_literals
+from django.core.exceptions import ImproperlyConfigured
+from django.db import (
+    DEFAULT_DB_ALIAS, IntegrityError, OperationalError, connections, models,
+    transaction
+)
+
+
+class OrderNumberSequence(models.Model):
+    '''
+    "hi" counter of a hi/lo ORDERNUMBER allocator. Every reserve() call
+    hands out one block of order numbers to a single worker process.
+    '''
+    name = models.CharField(max_length=64, primary_key=True)
+    next_hi = models.BigIntegerField(default=0)
+
+    @classmethod
+    def reserve(cls, name, using=DEFAULT_DB_ALIAS):
+        '''
+        Returns the next "hi" value of sequence `name`.
+
+        The increment runs on a private connection and is committed at
+        once, so it survives a rollback of the caller's transaction (e.g.
+        ATOMIC_REQUESTS) and the row is not locked until that ends.
+
+        SQLite allows a single writer, so there the caller's connection
+        is used outside a transaction, and inside a transaction which has
+        already written ImproperlyConfigured is raised instead of waiting
+        for the caller's own lock.
+        '''
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        params = {
+            'table': qn(cls._meta.db_table),
+            'name': qn(cls._meta.get_field('name').column),
+            'hi': qn(cls._meta.get_field('next_hi').column),
+        }
+        if connection.vendor == 'sqlite':
+            if connection.get_autocommit():
+                return cls._reserve_shared(connection, params, name, using)
+            settings_dict = dict(connection.settings_dict)
+            settings_dict['OPTIONS'] = dict(
+                settings_dict.get('OPTIONS') or {}, timeout=0
+            )
+            private = connection.__class__(settings_dict, using)
+        else:
+            private = connection.__class__(connection.settings_dict, using)
+        try:
+            private.set_autocommit(False)
+            # a concurrent first reservation may win the INSERT; the retry
+            # then finds its row
+            for attempt in range(2):
+                try:
+                    hi = cls._increment(private, params, name)
+                    private.commit()
+                    return hi
+                except IntegrityError:
+                    private.rollback()
+                    if attempt:
+                        raise
+        except OperationalError as e:
+            private.rollback()
+            if private.vendor == 'sqlite' and 'locked' in '%s' % e:
+                raise ImproperlyConfigured(
+                    "SQLite cannot reserve order numbers of sequence '%s' "
+                    "inside a transaction which has written to the "
+                    "database. Allocate the order number before writing "
+                    "or use another database." % name
+                )
+            raise
+        except Exception:
+            private.rollback()
+            raise
+        finally:
+            private.close()
+
+    @classmethod
+    def _reserve_shared(cls, connection, params, name, using):
+        for attempt in range(2):
+            try:
+                with transaction.atomic(using=using):
+                    return cls._increment(connection, params, name)
+            except IntegrityError:
+                if attempt:
+                    raise
+
+    @classmethod
+    def _increment(cls, private, params, name):
+        with private.cursor() as cursor:
+            cursor.execute(
+                'UPDATE %(table)s SET %(hi)s = %(hi)s + 1 '
+                'WHERE %(name)s = %%s' % params,
+                [name]
+            )
+            if cursor.rowcount == 0:
+                cursor.execute(
+                    'INSERT INTO %(table)s (%(name)s, %(hi)s) '
+                    'VALUES (%%s, 1)' % params,
+                    [name]
+                )
+                return 0
+            cursor.execute(
+                'SELECT %(hi)s FROM %(table)s WHERE %(name)s = %%s' % params,
+                [name]
+            )
+            return cursor.fetchone()[0] - 1
+
+
+class AuditEvent(models.Model):
+    '''
+    Signed request or gateway callback, written by ModelAuditSink.
+    '''
+    created = models.DateTimeField(db_index=True)
+    kind = models.CharField(max_length=16)
+    payment_id = models.CharField(max_length=64, blank=True, db_index=True)
+    order_number = models.CharField(max_length=32, blank=True)
+    outcome = models.CharField(max_length=16)
+    duration = models.FloatField()
+    fields = models.TextField()
+    errors = models.TextField(blank=True)
@@ -0,0 +1,165 @@
+from __future__ import unicode_literals
+import atexit
+import cProfile
+import functools
+import itertools
+import os
+import pstats
+import random
+import threading
+import time
+
+
+PROFILE_SUFFIX = '.prof'
+
+_file_counter = itertools.count()
+
+
+def profiled(name):
+    '''
+    Profiles the decorated provider method with the provider's profiler,
+    if it has one.
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            profiler = getattr(self, 'profiler', None)
+            if profiler is None:
+                return method(self, *args, **kwargs)
+            return profiler.profile(name, method, self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_directory_size(directory):
+    size = 0
+    for name in os.listdir(directory):
+        if name.endswith(PROFILE_SUFFIX):
+            size += os.path.getsize(os.path.join(directory, name))
+    return size
+
+
+class SamplingProfiler(object):
+    '''
+    Runs a sample_rate fraction of calls under cProfile and aggregates the
+    results per call name in memory.
+
+    A background thread dumps the aggregated stats to `directory` every
+    `interval` seconds (and on interpreter exit) as
+    <prefix>-<name>-<pid>-<timestamp>-<n>.prof files, so profiled calls
+    never do file I/O. A dump that would bring the .prof files in
+    `directory` over max_bytes is discarded and profiling stops for good,
+    as it does max_duration seconds after the profiler was created.
+
+    With threaded=False stats are only written by explicit dump() calls.
+    '''
+
+    def __init__(self, directory, sample_rate=0.01, interval=60,
+                 max_bytes=50 * 1024 * 1024, max_duration=None,
+                 prefix='gpwebpay', threaded=True):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.max_duration = max_duration
+        self.prefix = prefix
+        self.threaded = threaded
+        self.started = time.time()
+        self.exhausted = False
+        self.stats = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._dump_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+        self._local = threading.local()
+        atexit.register(self.close)
+
+    def should_profile(self):
+        if self.exhausted or getattr(self._local, 'active', False):
+            return False
+        if self.max_duration is not None \
+                and time.time() - self.started > self.max_duration:
+            self.exhausted = True
+            return False
+        return random.random() < self.sample_rate
+
+    def profile(self, name, func, *args, **kwargs):
+        if not self.should_profile():
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is already active in this thread
+            return func(*args, **kwargs)
+        self._local.active = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            self._local.active = False
+            self.add(name, profile)
+
+    def _ensure_thread(self):
+        # threads are not inherited by forked workers
+        if self._thread_pid == os.getpid() and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run,
+            name='gpwebpay-profiler'
+        )
+        self._thread.daemon = True
+        self._thread_pid = os.getpid()
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.dump()
+            if self.exhausted:
+                break
+
+    def add(self, name, profile):
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked worker: samples of the parent are its to dump
+                self.stats = {}
+                self._pid = os.getpid()
+            if name in self.stats:
+                self.stats[name].add(profile)
+            else:
+                self.stats[name] = pstats.Stats(profile)
+            if self.threaded:
+                self._ensure_thread()
+
+    def dump(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self.stats = {}
+                self._pid = os.getpid()
+            stats, self.stats = self.stats, {}
+        if not stats:
+            return
+        # files are written without holding _lock, so sampled calls
+        # are never blocked by a dump
+        with self._dump_lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            size = get_directory_size(self.directory)
+            timestamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+            for name, data in stats.items():
+                path = os.path.join(self.directory, '%s-%s-%s-%s-%s%s' % (
+                    self.prefix, name, os.getpid(), timestamp,
+                    next(_file_counter), PROFILE_SUFFIX
+                ))
+                data.dump_stats(path)
+                size += os.path.getsize(path)
+                if size > self.max_bytes:
+                    os.remove(path)
+                    self.exhausted = True
+                    break
+
+    def close(self):
+        self._stopped.set()
+        self.dump()
@@ -0,0 +1,9 @@
+from __future__ import unicode_literals
+from django.conf.urls import url
+
+from .views import process_notification
+
+urlpatterns = [
+    url(r'^process/(?P<variant>[^/]+)/$', process_notification,
+        name='gpwebpay_process_payment'),
+]
@@ -0,0 +1,25 @@
+from __future__ import unicode_literals
+from django.http import Http404
+from django.db.transaction import atomic
+from django.views.decorators.csrf import csrf_exempt
+
+from payments.core import provider_factory
+
+
+@csrf_exempt
+@atomic
+def process_notification(request, variant):
+    '''
+    GpWebPay callback routed by ORDERNUMBER (or MERORDERNUM, depending on
+    the provider's order number allocator) instead of payment token.
+
+    Raises Http404 if variant does not exist or is not a GpWebPay one.
+    '''
+    from . import GpwebpayProvider
+    try:
+        provider = provider_factory(variant)
+    except ValueError:
+        raise Http404('No such provider')
+    if not isinstance(provider, GpwebpayProvider):
+        raise Http404('No such provider')
+    return provider.process_notification(request, variant)
@@ -8,6 +8,9 @@ os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 
 PACKAGES = [
     'payments_gpwebpay',
+    'payments_gpwebpay.management',
+    'payments_gpwebpay.management.commands',
+    'payments_gpwebpay.migrations',
 ]
 
 REQUIREMENTS = [
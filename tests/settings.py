@@ -18,6 +18,7 @@ DEBUG = True
 INSTALLED_APPS = (
     'django.contrib.sites',
     'payments',
+    'payments_gpwebpay',
 
     'tests'
 )
@@ -51,5 +52,7 @@ GPWEBPAY_CREDENTIALS['use_redirect'] = False
 
 
 PAYMENT_VARIANTS = {
-    'default': ('payments_gpwebpay.GpwebpayProvider', GPWEBPAY_CREDENTIALS)
+    'default': ('payments_gpwebpay.GpwebpayProvider', GPWEBPAY_CREDENTIALS),
+    'gpwebpay_cz': ('payments_gpwebpay.GpwebpayProvider', GPWEBPAY_CREDENTIALS),
+    'dummy': ('payments.dummy.DummyProvider', {})
 }
@@ -1,16 +1,32 @@
 # -*- coding: utf-8 -*-
+import gzip
 import hashlib
 import hmac
+import json
+import os
+import shutil
+import tempfile
+import threading
 from decimal import Decimal
 
-from django.test import TestCase
-from django.http import HttpResponse, HttpResponseForbidden
+from django.test import TestCase, TransactionTestCase, RequestFactory
+from django.http import Http404, HttpResponse, HttpResponseForbidden, \
+    HttpResponseRedirect
 from django.conf import settings
-from mock import MagicMock, Mock
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from mock import MagicMock, Mock, patch
+from six import StringIO
 
 from .models import Payment
 from payments import PaymentStatus
 from payments_gpwebpay import GpwebpayProvider, helpers
+from payments_gpwebpay.audit import AuditLog, JsonlAuditSink
+from payments_gpwebpay.models import AuditEvent
+from payments_gpwebpay.ordernumbers import HiLoAllocator
+from payments_gpwebpay.views import process_notification
 
 GPWEBPAY_CREDENTIALS = settings.GPWEBPAY_CREDENTIALS
 
@@ -56,11 +72,35 @@ def get_getdata_with_sha1(signature, payment, **kwargs):
         'USERPARAM1', 'ADDINFO'
     ])
     digest1 = "%s|%s" % (digest, GPWEBPAY_CREDENTIALS['merchant_id'])
-    data['DIGEST'] = signature.sign(digest)
-    data['DIGEST1'] = signature.sign(digest1)
+    data['DIGEST'] = helpers.to_str(signature.sign(digest))
+    data['DIGEST1'] = helpers.to_str(signature.sign(digest1))
     return data
 
 
+def get_provider(**options):
+    credentials = dict(GPWEBPAY_CREDENTIALS)
+    credentials.update(options)
+    return GpwebpayProvider(**credentials)
+
+
+class ProviderFixtureMixin(object):
+
+    def setUp(self):
+        super(ProviderFixtureMixin, self).setUp()
+        self.signature = helpers.RsaSignature(
+            GPWEBPAY_CREDENTIALS['private_key'],
+            GPWEBPAY_CREDENTIALS['public_key'],
+            GPWEBPAY_CREDENTIALS['passphrase_for_key']
+        )
+        self.payment = Payment.objects.create(
+            variant='default',
+            description='Book purchase',
+            total=Decimal(120),
+            currency='USD',
+            customer_ip_address='127.0.0.1'
+        )
+
+
 class RsaSignatureTest(TestCase):
 
     def setUp(self):
@@ -197,3 +237,535 @@ class GatewayTest(TestCase):
         provider = GpwebpayProvider(**GPWEBPAY_CREDENTIALS)
         response = provider.process_data(self.payment3, request)
         self.assertEqual(type(response), HttpResponseForbidden)
+
+
+class NotificationViewTest(ProviderFixtureMixin, TestCase):
+
+    def setUp(self):
+        super(NotificationViewTest, self).setUp()
+        self.factory = RequestFactory()
+
+    def test_payment_accepted(self):
+        """process_notification() routes the callback by ORDERNUMBER"""
+        request = self.factory.get('/', get_getdata_with_sha1(
+            self.signature,
+            self.payment
+        ))
+        with CaptureQueriesContext(connection) as queries:
+            response = process_notification(request, 'default')
+        self.assertEqual(type(response), HttpResponse)
+        statements = [
+            q['sql'].split(' ')[0] for q in queries.captured_queries
+            if 'SAVEPOINT' not in q['sql']
+        ]
+        self.assertEqual(statements, ['SELECT', 'UPDATE'])
+        self.assertNotIn('description', queries.captured_queries[-2]['sql'])
+        payment = Payment.objects.get(id=self.payment.id)
+        self.assertEqual(payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(payment.description, 'Book purchase')
+
+    def test_payment_accepted_redirect(self):
+        """process_notification() builds the redirect from loaded columns"""
+        provider = get_provider(
+            use_redirect=True,
+            notification_payment_fields=['currency']
+        )
+        self.assertIn('currency', provider.notification_payment_fields)
+        request = self.factory.get('/', get_getdata_with_sha1(
+            self.signature,
+            self.payment
+        ))
+        with CaptureQueriesContext(connection) as queries:
+            response = provider.process_notification(request, 'default')
+        self.assertEqual(type(response), HttpResponseRedirect)
+        self.assertEqual(response['Location'], self.payment.get_success_url())
+        statements = [
+            q['sql'].split(' ')[0] for q in queries.captured_queries
+        ]
+        self.assertEqual(statements, ['SELECT', 'UPDATE'])
+        self.assertIn('currency', queries.captured_queries[0]['sql'])
+
+    def test_bad_digest_does_not_query(self):
+        """process_notification() rejects bad digests before loading payment"""
+        data = get_getdata_with_sha1(self.signature, self.payment)
+        data['DIGEST'] = 'INVALID'
+        request = self.factory.get('/', data)
+        with CaptureQueriesContext(connection) as queries:
+            response = process_notification(request, 'default')
+        self.assertEqual(type(response), HttpResponseForbidden)
+        self.assertFalse([
+            q for q in queries.captured_queries
+            if 'SAVEPOINT' not in q['sql']
+        ])
+        payment = Payment.objects.get(id=self.payment.id)
+        self.assertEqual(payment.status, PaymentStatus.WAITING)
+
+    def test_unknown_payment(self):
+        """process_notification() raises 404 for unknown ORDERNUMBER"""
+        data = get_getdata_with_sha1(
+            self.signature,
+            self.payment,
+            ORDERNUMBER='%s' % (self.payment.id + 1000)
+        )
+        request = self.factory.get('/', data)
+        with self.assertRaises(Http404):
+            process_notification(request, 'default')
+
+    def test_wrong_variant(self):
+        """process_notification() raises 404 for another variant's payment"""
+        request = self.factory.get('/', get_getdata_with_sha1(
+            self.signature,
+            self.payment
+        ))
+        with self.assertRaises(Http404):
+            process_notification(request, 'gpwebpay_cz')
+        payment = Payment.objects.get(id=self.payment.id)
+        self.assertEqual(payment.status, PaymentStatus.WAITING)
+
+    def test_not_gpwebpay_variant(self):
+        """process_notification() raises 404 for other providers"""
+        request = self.factory.get('/', get_getdata_with_sha1(
+            self.signature,
+            self.payment
+        ))
+        with self.assertRaises(Http404):
+            process_notification(request, 'dummy')
+        with self.assertRaises(Http404):
+            process_notification(request, 'unknown')
+
+    def test_return_url(self):
+        """get_return_url() points at the notification view of the variant"""
+        provider = get_provider(use_notification_view=True)
+        payment = Payment(variant='gpwebpay_cz')
+        url = 'https://localhost:8000/payments/gpwebpay/process/gpwebpay_cz/'
+        with override_settings():
+            del settings.TEST_SITE_URL
+            del settings.TEST_HOSTNAME
+            self.assertEqual(provider.get_return_url(payment), url)
+            self.assertEqual(
+                provider.get_return_url(payment, {'a': 1}), url + '?a=1'
+            )
+
+
+class HiLoAllocatorTest(ProviderFixtureMixin, TransactionTestCase):
+
+    def get_provider(self, **options):
+        return get_provider(
+            order_number_allocator='payments_gpwebpay.ordernumbers.'
+                                   'HiLoAllocator',
+            order_number_allocator_options=options
+        )
+
+    def test_blocks(self):
+        """HiLoAllocator hits the database once per block"""
+        allocator = HiLoAllocator(1000, name='test', block_size=3)
+        self.assertEqual(allocator.allocate(self.payment), '1001')
+        with self.assertNumQueries(0):
+            self.assertEqual(allocator.allocate(self.payment), '1002')
+            self.assertEqual(allocator.allocate(self.payment), '1003')
+
+        other = HiLoAllocator(1000, name='test', block_size=3)
+        self.assertEqual(other.allocate(self.payment), '1004')
+        self.assertEqual(allocator.allocate(self.payment), '1007')
+
+    def test_offset_required(self):
+        """HiLoAllocator needs an offset above already used order numbers"""
+        with self.assertRaises(TypeError):
+            self.get_provider(name='test')
+        with self.assertRaises(ValueError):
+            HiLoAllocator(None)
+        provider = self.get_provider(offset=self.payment.id)
+        order_number = provider.get_hidden_fields(self.payment)['ORDERNUMBER']
+        self.assertGreater(int(order_number), self.payment.id)
+
+    def test_reservation_survives_rollback(self):
+        """HiLoAllocator blocks are not released by the caller's rollback"""
+        allocator = HiLoAllocator(0, name='test', block_size=3)
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.assertEqual(allocator.allocate(self.payment), '1')
+                raise ValueError('rollback')
+        other = HiLoAllocator(0, name='test', block_size=3)
+        self.assertEqual(other.allocate(self.payment), '4')
+        self.assertEqual(allocator.allocate(self.payment), '2')
+
+    def test_max_digits(self):
+        """HiLoAllocator refuses numbers longer than the gateway allows"""
+        allocator = HiLoAllocator(10 ** 15 - 10, name='test')
+        with self.assertRaises(ValueError):
+            allocator.allocate(self.payment)
+
+    def test_sqlite_transaction(self):
+        """HiLoAllocator fails at once on SQLite after the caller wrote"""
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only')
+        allocator = HiLoAllocator(0, name='test')
+        self.assertEqual(allocator.allocate(self.payment), '1')
+        other = HiLoAllocator(0, name='test')
+        with transaction.atomic():
+            Payment.objects.create(
+                variant='default',
+                total=Decimal(10),
+                currency='USD'
+            )
+            with self.assertRaises(ImproperlyConfigured):
+                other.allocate(self.payment)
+
+    def test_retry_gets_new_order_number(self):
+        """get_hidden_fields() sends a new ORDERNUMBER on every attempt"""
+        provider = self.get_provider(name='test', offset=5000)
+        first = provider.get_hidden_fields(self.payment)
+        second = provider.get_hidden_fields(self.payment)
+        self.assertNotEqual(first['ORDERNUMBER'], second['ORDERNUMBER'])
+        self.assertEqual(first['MERORDERNUM'], '%s' % self.payment.id)
+
+    def test_process_data(self):
+        """process_data() maps the payment back through MERORDERNUM"""
+        provider = self.get_provider(name='test', offset=5000)
+        request = MagicMock()
+        request.GET = get_getdata_with_sha1(
+            self.signature,
+            self.payment,
+            ORDERNUMBER=provider.get_hidden_fields(self.payment)['ORDERNUMBER']
+        )
+        response = provider.process_data(self.payment, request)
+        self.assertEqual(type(response), HttpResponse)
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+
+        request.GET = get_getdata_with_sha1(
+            self.signature,
+            self.payment,
+            MERORDERNUM='%s' % (self.payment.id + 1000)
+        )
+        response = provider.process_data(self.payment, request)
+        self.assertEqual(type(response), HttpResponseForbidden)
+
+
+class MemoryAuditSink(object):
+
+    def __init__(self):
+        self.batches = []
+        self.written = threading.Event()
+
+    def write(self, events):
+        self.batches.append(list(events))
+        self.written.set()
+
+
+class AuditLogTest(ProviderFixtureMixin, TestCase):
+
+    def get_provider(self, sink, **options):
+        return get_provider(
+            audit_sink=sink,
+            audit_options=dict(threaded=False, **options)
+        )
+
+    def test_provider_events(self):
+        """get_hidden_fields() and process_data() are audited"""
+        sink = MemoryAuditSink()
+        provider = self.get_provider(sink)
+        provider.get_hidden_fields(self.payment)
+        request = MagicMock()
+        request.GET = get_getdata_with_sha1(self.signature, self.payment)
+        request.GET['DIGEST'] = 'INVALID'
+        provider.process_data(self.payment, request)
+        provider.audit_log.flush()
+
+        events = [e for batch in sink.batches for e in batch]
+        self.assertEqual(
+            [(e['kind'], e['outcome']) for e in events],
+            [('request', 'signed'), ('callback', 'rejected')]
+        )
+        self.assertEqual(events[1]['fields']['DIGEST'], 'INVALID')
+        self.assertIn('DIGEST', events[1]['errors'])
+
+    def test_overflow_drop(self):
+        """AuditLog drops events when the buffer is full"""
+        sink = MemoryAuditSink()
+        log = AuditLog(sink, buffer_size=2, threaded=False)
+        with patch('payments_gpwebpay.audit.logger') as logger:
+            results = [log.record({'n': i}) for i in range(4)]
+        self.assertEqual(results, [True, True, False, False])
+        self.assertEqual(log.dropped, 2)
+        self.assertEqual(logger.warning.call_count, 1)
+        log.close()
+        self.assertEqual(sink.batches, [[{'n': 0}, {'n': 1}]])
+        self.assertFalse(log.record({'n': 4}))
+
+    def test_synchronous_batches(self):
+        """AuditLog(threaded=False) writes full batches from record()"""
+        sink = MemoryAuditSink()
+        log = AuditLog(sink, batch_size=2, threaded=False)
+        for i in range(3):
+            log.record({'n': i})
+        self.assertEqual(sink.batches, [[{'n': 0}, {'n': 1}]])
+        log.flush()
+        self.assertEqual(sink.batches[-1], [{'n': 2}])
+        self.assertIsNone(log._thread)
+
+    def test_threaded_batches(self):
+        """AuditLog writer thread collects events into one batch"""
+        sink = MemoryAuditSink()
+        log = AuditLog(sink, batch_size=3, flush_interval=5)
+        self.addCleanup(log.close)
+        for i in range(2):
+            log.record({'n': i})
+            self.assertFalse(sink.written.wait(0.05))
+        log.record({'n': 2})
+        self.assertTrue(sink.written.wait(5))
+        self.assertEqual(sink.batches, [[{'n': 0}, {'n': 1}, {'n': 2}]])
+
+        sink = MemoryAuditSink()
+        log = AuditLog(sink, batch_size=100, flush_interval=0.2)
+        self.addCleanup(log.close)
+        log.record({'n': 3})
+        log.record({'n': 4})
+        self.assertTrue(sink.written.wait(5))
+        self.assertEqual(sink.batches, [[{'n': 3}, {'n': 4}]])
+
+    def test_sink_errors_are_logged(self):
+        """AuditLog retries and logs batches its sink could not write"""
+        sink = MagicMock()
+        sink.write.side_effect = [IOError('disk full'), None]
+        log = AuditLog(sink, retry_delay=0, threaded=False)
+        log.record({'n': 1})
+        with patch('payments_gpwebpay.audit.logger') as logger:
+            log.flush()
+        self.assertEqual(sink.write.call_count, 2)
+        self.assertEqual(logger.exception.call_count, 1)
+        self.assertEqual(log.dropped, 0)
+
+        sink.write.reset_mock()
+        sink.write.side_effect = IOError('disk full')
+        log.record({'n': 2})
+        with patch('payments_gpwebpay.audit.logger') as logger:
+            log.flush()
+        self.assertEqual(sink.write.call_count, 4)
+        self.assertEqual(logger.exception.call_count, 4)
+        self.assertTrue(logger.warning.called)
+        self.assertEqual(log.dropped, 1)
+
+    def test_close_waits_for_writer(self):
+        """AuditLog.close() lets the writer thread finish its batch"""
+        started = threading.Event()
+        release = threading.Event()
+        sink = MemoryAuditSink()
+        write = sink.write
+
+        def blocking_write(events):
+            started.set()
+            release.wait(5)
+            write(events)
+
+        sink.write = blocking_write
+        log = AuditLog(sink, batch_size=1)
+        log.record({'n': 1})
+        self.assertTrue(started.wait(5))
+        closer = threading.Thread(target=log.close)
+        closer.start()
+        closer.join(0.05)
+        self.assertTrue(closer.is_alive())
+        release.set()
+        closer.join(5)
+        self.assertFalse(closer.is_alive())
+        self.assertEqual(sink.batches, [[{'n': 1}]])
+
+    def test_model_sink(self):
+        """ModelAuditSink stores events with bulk_create"""
+        provider = self.get_provider(
+            'payments_gpwebpay.audit.ModelAuditSink'
+        )
+        provider.get_hidden_fields(self.payment)
+        provider.audit_log.flush()
+        event = AuditEvent.objects.get()
+        self.assertEqual(event.payment_id, '%s' % self.payment.id)
+        self.assertEqual(json.loads(event.fields)['ORDERNUMBER'],
+                         '%s' % self.payment.id)
+
+    def test_jsonl_sink(self):
+        """JsonlAuditSink rotates gzipped JSON lines files"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        sink = JsonlAuditSink(directory, max_bytes=1)
+        sink.write([{'n': 1}, {'n': 2}])
+        sink.write([{'n': 3}])
+        files = sorted(os.listdir(directory))
+        self.assertEqual(len(files), 2)
+        lines = []
+        for name in files:
+            with gzip.open(os.path.join(directory, name), 'rb') as f:
+                lines.extend(json.loads(l.decode('utf-8')) for l in f)
+        self.assertEqual(sorted(l['n'] for l in lines), [1, 2, 3])
+
+        for name in files:
+            os.remove(os.path.join(directory, name))
+        sink = JsonlAuditSink(directory)
+        sink.write([{'n': 1}])
+        os.remove(sink.path)
+        with self.assertRaises(OSError):
+            sink.write([{'n': 2}])
+        sink.write([{'n': 3}])
+        self.assertEqual(len(os.listdir(directory)), 1)
+
+
+class VerifyCallbacksCommandTest(ProviderFixtureMixin, TestCase):
+
+    def setUp(self):
+        super(VerifyCallbacksCommandTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write_archive(self, records):
+        path = os.path.join(self.directory, 'callbacks.jsonl')
+        with open(path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        return path
+
+    def test_verify(self):
+        """verify_gpwebpay_callbacks reports bad digests and statuses"""
+        bad_digest = get_getdata_with_sha1(self.signature, self.payment)
+        bad_digest['DIGEST1'] = 'INVALID'
+        archive = self.write_archive([
+            get_getdata_with_sha1(self.signature, self.payment),
+            {
+                'fields': get_getdata_with_sha1(
+                    self.signature, self.payment, PRCODE='5'
+                ),
+                'status': PaymentStatus.CONFIRMED
+            },
+            bad_digest,
+        ])
+        report = os.path.join(self.directory, 'report.jsonl')
+        out = StringIO()
+        for processes in [1, 2]:
+            call_command(
+                'verify_gpwebpay_callbacks', archive,
+                processes=processes, report=report, stdout=out
+            )
+            summary = json.loads(out.getvalue())
+            out.truncate(0)
+            out.seek(0)
+            self.assertEqual(summary['total'], 3)
+            self.assertEqual(summary['verified'], 2)
+            self.assertEqual(summary['bad_digest1'], 1)
+            self.assertEqual(summary['status_mismatch'], 1)
+            self.assertEqual(summary['certificates'], {'default': 2})
+            with open(report) as f:
+                problems = sorted(
+                    json.loads(line)['problems'] for line in f
+                )
+            self.assertEqual(problems, [['DIGEST1'], ['status']])
+
+    def test_null_fields(self):
+        """verify_gpwebpay_callbacks ignores null fields of the archive"""
+        record = get_getdata_with_sha1(self.signature, self.payment)
+        record['RESULTTEXT'] = None
+        record['ADDINFO'] = None
+        out = StringIO()
+        call_command(
+            'verify_gpwebpay_callbacks', self.write_archive([record]),
+            processes=1, stdout=out
+        )
+        summary = json.loads(out.getvalue())
+        self.assertEqual(summary['verified'], 1)
+        self.assertEqual(summary['bad_digest'], 0)
+        self.assertEqual(summary['bad_digest1'], 0)
+
+    def test_audit_log(self):
+        """verify_gpwebpay_callbacks reads JsonlAuditSink files"""
+        sink = JsonlAuditSink(self.directory)
+        provider = get_provider(
+            audit_sink=sink,
+            audit_options={'threaded': False}
+        )
+        provider.get_hidden_fields(self.payment)
+        request = MagicMock()
+        request.GET = get_getdata_with_sha1(self.signature, self.payment)
+        provider.process_data(self.payment, request)
+        provider.audit_log.flush()
+        out = StringIO()
+        call_command(
+            'verify_gpwebpay_callbacks', sink.path,
+            processes=1, stdout=out
+        )
+        summary = json.loads(out.getvalue())
+        self.assertEqual(summary['total'], 1)
+        self.assertEqual(summary['verified'], 1)
+        self.assertEqual(summary['invalid'], 0)
+
+
+class SamplingProfilerTest(ProviderFixtureMixin, TestCase):
+
+    def setUp(self):
+        super(SamplingProfilerTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def get_provider(self, **options):
+        options.setdefault('threaded', False)
+        return get_provider(
+            profiler='payments_gpwebpay.profiling.SamplingProfiler',
+            profiler_options=dict(directory=self.directory, **options)
+        )
+
+    def test_profile_and_merge(self):
+        """SamplingProfiler dumps stats merged by gpwebpay_profile_stats"""
+        provider = self.get_provider(sample_rate=1)
+        for i in range(3):
+            provider.get_hidden_fields(self.payment)
+        provider.profiler.dump()
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+        out = StringIO()
+        call_command(
+            'gpwebpay_profile_stats', self.directory,
+            name=['get_hidden_fields'], stdout=out
+        )
+        self.assertIn('Merged 1 profile dumps', out.getvalue())
+        self.assertIn('generate_digest', out.getvalue())
+
+    def test_sample_rate(self):
+        """SamplingProfiler skips unsampled calls"""
+        provider = self.get_provider(sample_rate=0)
+        provider.get_hidden_fields(self.payment)
+        self.assertEqual(provider.profiler.stats, {})
+
+    def test_max_bytes(self):
+        """SamplingProfiler stops once the size budget is used"""
+        provider = self.get_provider(sample_rate=1, max_bytes=1)
+        provider.get_hidden_fields(self.payment)
+        provider.profiler.dump()
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertTrue(provider.profiler.exhausted)
+        provider.get_hidden_fields(self.payment)
+        self.assertEqual(provider.profiler.stats, {})
+
+    def test_dump_in_background(self):
+        """SamplingProfiler writes dumps from its own thread only"""
+        provider = self.get_provider(sample_rate=1, interval=0)
+        provider.get_hidden_fields(self.payment)
+        self.assertEqual(os.listdir(self.directory), [])
+        provider.profiler.dump()
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+        provider = self.get_provider(
+            sample_rate=1, interval=0.01, threaded=True
+        )
+        profiler = provider.profiler
+        dumped = threading.Event()
+        threads = []
+        dump = profiler.dump
+
+        def recording_dump():
+            threads.append(threading.current_thread())
+            dump()
+            dumped.set()
+
+        profiler.dump = recording_dump
+        provider.get_hidden_fields(self.payment)
+        self.assertTrue(dumped.wait(5))
+        profiler.close()
+        self.assertIs(threads[0], profiler._thread)
+        self.assertIsNot(threads[0], threading.current_thread())
+        self.assertEqual(len(os.listdir(self.directory)), 2)
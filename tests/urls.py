@@ -4,5 +4,6 @@ from .views import payment_details
 urlpatterns = [
     url('^([0-9]+)/', payment_details),
     url('^failure/', payment_details),
+    url('^payments/gpwebpay/', include('payments_gpwebpay.urls')),
     url('^payments/', include('payments.urls'))
 ]